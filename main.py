@@ -1,9 +1,19 @@
 import streamlit as st
 import json
+import orjson
 import os
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
+import zlib
+import base64
+import hashlib
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # =========================
 # KONFIGURACE
@@ -12,40 +22,152 @@ import io
 DATA_DIR = "data"
 PROJECTS_DIR = os.path.join(DATA_DIR, "projects")
 os.makedirs(PROJECTS_DIR, exist_ok=True)
+MAX_PARALLEL_REQUESTS = 10
+REQUEST_TIMEOUT = 45
+GENERATION_TIMEOUT = 300
+COMPLETION_CACHE_SIZE = 200
+RECENT_CHAPTERS = 3
+SUMMARY_EVERY = 5
+MAX_VERBATIM_CHAPTERS = RECENT_CHAPTERS + SUMMARY_EVERY - 1
+SUMMARY_MAX_TOKENS = 800
+SUMMARY_TEMPERATURE = 0.3
 
 # =========================
 # NAČTENÍ MODELŮ
 # =========================
 
+@st.cache_resource
 def load_models():
+    # jeden seznam pro všechny relace serveru, nesmí se proto měnit
     with open("models.json", "r", encoding="utf-8") as f:
         return json.load(f)["models"]
 
 MODELS = load_models()
 MODEL_LABELS = [m["label"] for m in MODELS]
+MODEL_BY_LABEL = {m["label"]: m for m in MODELS}
 
 # =========================
 # POMOCNÉ FUNKCE
 # =========================
 
+def project_path(project_name, *parts):
+    return os.path.join(PROJECTS_DIR, project_name, *parts)
+
+def read_json(path):
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+def write_json(path, data):
+    # zápis přes dočasný soubor, aby pád uprostřed ukládání nepoškodil projekt
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(data))
+    os.replace(tmp_path, path)
+
+@st.cache_data
+def list_projects_cached(mtime_ns):
+    # mtime adresáře se mění jen při přidání/odebrání položky
+    names = set()
+    with os.scandir(PROJECTS_DIR) as entries:
+        for e in entries:
+            if e.is_dir():
+                # adresář bez manifestu (např. po nedokončeném vytvoření) není projekt
+                if os.path.exists(os.path.join(e.path, "project.json")):
+                    names.add(e.name)
+            elif e.name.endswith(".json"):
+                # projekt ve starém formátu (jeden soubor), převede se při načtení
+                names.add(e.name[:-len(".json")])
+    return sorted(names)
+
 def list_projects():
-    return [f.replace(".json", "") for f in os.listdir(PROJECTS_DIR) if f.endswith(".json")]
+    return list_projects_cached(os.stat(PROJECTS_DIR).st_mtime_ns)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_project_cached(project_name, mtimes):
+    # klíčem je mtime manifestu i adresáře kapitol, soubory se znovu čtou jen po změně
+    project = read_json(project_path(project_name, "project.json"))
+    project["chapters"] = [
+        read_json(project_path(project_name, "chapters", f"{chapter_id}.json"))
+        for chapter_id in project["chapters"]
+    ]
+    return project
+
+def migrate_legacy_project(project_name):
+    legacy_path = os.path.join(PROJECTS_DIR, f"{project_name}.json")
+    save_project(project_name, read_json(legacy_path))
+    os.remove(legacy_path)
 
 def load_project(project_name):
-    path = os.path.join(PROJECTS_DIR, f"{project_name}.json")
-    if not os.path.exists(path):
+    # projekt ve starém formátu se převede na manifest + soubory kapitol
+    if os.path.exists(os.path.join(PROJECTS_DIR, f"{project_name}.json")):
+        migrate_legacy_project(project_name)
+    manifest_path = project_path(project_name, "project.json")
+    if not os.path.exists(manifest_path):
         return None
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    mtimes = (os.stat(manifest_path).st_mtime_ns, os.stat(project_path(project_name, "chapters")).st_mtime_ns)
+    return load_project_cached(project_name, mtimes)
+
+def save_manifest(project_name, data):
+    # manifest drží vše kromě textů kapitol, ty jsou v samostatných souborech
+    manifest = {**data, "chapters": [chapter["id"] for chapter in data["chapters"]]}
+    write_json(project_path(project_name, "project.json"), manifest)
+    load_project_cached.clear()
+
+def save_chapter(project_name, chapter):
+    if "id" not in chapter:
+        chapter["id"] = uuid.uuid4().hex
+    write_json(project_path(project_name, "chapters", f"{chapter['id']}.json"), chapter)
+    load_project_cached.clear()
 
 def save_project(project_name, data):
-    path = os.path.join(PROJECTS_DIR, f"{project_name}.json")
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.makedirs(project_path(project_name, "chapters"), exist_ok=True)
+    for chapter in data["chapters"]:
+        save_chapter(project_name, chapter)
+    save_manifest(project_name, data)
+    list_projects_cached.clear()
+
+def append_chapter(project_name, project, chapter):
+    # zapíše se jen nová kapitola a manifest, ne celý projekt
+    project["chapters"].append(chapter)
+    save_chapter(project_name, chapter)
+    save_manifest(project_name, project)
+
+def delete_chapter(project_name, project, chapter_index):
+    chapter = project["chapters"].pop(chapter_index)
+    reset_summary_from(project, chapter_index)
+    save_manifest(project_name, project)
+    os.remove(project_path(project_name, "chapters", f"{chapter['id']}.json"))
+
+def iter_export(project_name, project):
+    yield f"Kniha: {project_name}\n\n"
+    yield "=== Postavy ===\n"
+    for c in project["characters"]:
+        yield f"- {c['name']}: {c['description']}\n"
+    yield "\n=== Děj ===\n"
+    for i, ch in enumerate(project["chapters"]):
+        yield f"Kapitola {i+1}: {ch['text']}\n\n"
+
+def characters_block(characters):
+    return "\n".join(f"- {c['name']}: {c['description']}" for c in characters)
+
+def chapters_block(chapters, first_index=0):
+    output = io.StringIO()
+    for i, ch in enumerate(chapters, start=first_index):
+        if i > first_index:
+            output.write("\n\n")
+        output.write(f"Kapitola {i+1}:\n")
+        output.write(ch["text"])
+    return output.getvalue()
 
 def build_prompt(project, chapter_instruction):
-    characters = "\n".join([f"- {c['name']}: {c['description']}" for c in project["characters"]])
-    previous_chapters = "\n\n".join([f"Kapitola {i+1}:\n{ch['text']}" for i, ch in enumerate(project["chapters"])])
+    characters = characters_block(project["characters"])
+    # starší kapitoly zastupuje shrnutí, doslovně se posílají jen ty novější;
+    # i když se shrnutí teprve obnovuje, doslovná část nepřekročí MAX_VERBATIM_CHAPTERS
+    summary_upto = project.get("summary_upto", 0)
+    verbatim_from = max(summary_upto, len(project["chapters"]) - MAX_VERBATIM_CHAPTERS)
+    previous_chapters = chapters_block(project["chapters"][verbatim_from:], verbatim_from)
+    if project.get("summary"):
+        previous_chapters = f"Shrnutí kapitol 1–{summary_upto}:\n{project['summary']}\n\n{previous_chapters}"
     plot = project.get("plot", "")
     prompt = f"""
 Plán knihy:
@@ -68,6 +190,80 @@ Dbej na kontinuitu děje, konzistenci postav, dramatické dialogy a emocionáln
 """
     return prompt.strip()
 
+def build_summary_prompt(project, upto):
+    summary_upto = project.get("summary_upto", 0)
+    chapters = chapters_block(project["chapters"][summary_upto:upto], summary_upto)
+    prompt = f"""
+Shrň děj románu do stručného a věcného přehledu v češtině.
+Zachovej jména postav, jejich vztahy a všechny události důležité pro další děj.
+Napiš jedno souvislé shrnutí, které zahrne dosavadní shrnutí i nové kapitoly.
+
+=== DOSAVADNÍ SHRNUTÍ ===
+{project.get("summary", "")}
+
+=== NOVÉ KAPITOLY ===
+{chapters}
+"""
+    return prompt.strip()
+
+# =========================
+# HTTP SPOJENÍ
+# =========================
+
+@st.cache_resource
+def get_http_session():
+    # sdílená session drží keep-alive spojení, TLS handshake se platí jen jednou
+    session = requests.Session()
+    retry = Retry(
+        total=2,
+        # vypršení čtení se neopakuje, placený požadavek už server mohl zpracovávat
+        read=0,
+        backoff_factor=1.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=["POST"],
+        # Retry-After u 429 může znamenat hodiny (denní kvóta), čekáme jen podle backoff_factor
+        respect_retry_after_header=False
+    )
+    adapter = HTTPAdapter(pool_connections=MAX_PARALLEL_REQUESTS, pool_maxsize=MAX_PARALLEL_REQUESTS, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    return session
+
+# =========================
+# CACHE VÝSTUPŮ MODELŮ
+# =========================
+
+@st.cache_resource
+def get_completion_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+def completion_key(prompt, cfg):
+    raw = json.dumps(
+        [cfg["provider"], cfg["endpoint"], cfg["model"], cfg.get("temperature"), cfg.get("max_tokens"), prompt],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def get_cached_completion(key):
+    cache = get_completion_cache()
+    with cache["lock"]:
+        text = cache["entries"].get(key)
+        if text is not None:
+            cache["entries"].move_to_end(key)
+        return text
+
+def store_completion(key, text):
+    # prázdné a chybové odpovědi neukládáme, aby se při dalším pokusu zavolal model
+    if not text or "CHYBA:" in text:
+        return
+    cache = get_completion_cache()
+    with cache["lock"]:
+        cache["entries"][key] = text
+        cache["entries"].move_to_end(key)
+        while len(cache["entries"]) > COMPLETION_CACHE_SIZE:
+            cache["entries"].popitem(last=False)
+
 # =========================
 # VOLÁNÍ MODELŮ
 # =========================
@@ -81,51 +277,210 @@ def generate_chapter(prompt, model_cfg):
     else:
         raise ValueError("Neznámý provider")
 
-def call_openai(prompt, cfg):
+def stream_chapter(prompt, model_cfg):
+    provider = model_cfg["provider"]
+    if provider == "openai":
+        return stream_openai(prompt, model_cfg)
+    elif provider == "ollama":
+        return stream_ollama(prompt, model_cfg)
+    else:
+        raise ValueError("Neznámý provider")
+
+def openai_headers(cfg):
     api_key = st.secrets.get(cfg.get("api_key_env"))
     if not api_key:
-        return "CHYBA: API klíč není v secrets."
-    headers = {
+        return None
+    return {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
-    payload = {
+
+def openai_payload(prompt, cfg, stream=False):
+    return {
         "model": cfg["model"],
         "messages": [
             {"role": "system", "content": "Jsi český spisovatel beletrie."},
             {"role": "user", "content": prompt}
         ],
         "temperature": cfg.get("temperature", 0.9),
-        "max_tokens": cfg.get("max_tokens", 1500)
+        "max_tokens": cfg.get("max_tokens", 1500),
+        "stream": stream
+    }
+
+def ollama_payload(prompt, cfg, stream=False):
+    # keep_alive drží model v paměti, aby se mezi voláními znovu nenačítal
+    payload = {
+        "model": cfg["model"],
+        "prompt": prompt,
+        "stream": stream,
+        "keep_alive": cfg.get("keep_alive", "30m")
     }
+    # num_ctx jen na výslovné přání, jinak platí nastavení serveru / Modelfile
+    if "num_ctx" in cfg:
+        payload["options"] = {"num_ctx": cfg["num_ctx"]}
+    return payload
+
+def stream_error_message(error):
+    # OpenRouter posílá {"message": ..., "code": ...}, Ollama jen text
+    if isinstance(error, dict):
+        return error.get("message", error)
+    return error
+
+def call_openai(prompt, cfg):
+    headers = openai_headers(cfg)
+    if headers is None:
+        return "CHYBA: API klíč není v secrets."
+    payload = openai_payload(prompt, cfg)
     try:
-        r = requests.post(cfg["endpoint"], headers=headers, json=payload, timeout=300)
+        # bez streamu přijde odpověď až po vygenerování celé kapitoly, proto delší timeout
+        r = get_http_session().post(cfg["endpoint"], headers=headers, json=payload, timeout=cfg.get("generation_timeout", GENERATION_TIMEOUT))
         r.raise_for_status()
         return r.json()["choices"][0]["message"]["content"]
     except requests.exceptions.RequestException as e:
         return f"CHYBA: Nelze se připojit k API: {e}"
 
+def stream_openai(prompt, cfg):
+    headers = openai_headers(cfg)
+    if headers is None:
+        yield "CHYBA: API klíč není v secrets."
+        return
+    payload = openai_payload(prompt, cfg, stream=True)
+    received = False
+    try:
+        with get_http_session().post(cfg["endpoint"], headers=headers, json=payload, stream=True, timeout=cfg.get("request_timeout", REQUEST_TIMEOUT)) as r:
+            r.raise_for_status()
+            r.encoding = "utf-8"
+            for line in r.iter_lines(decode_unicode=True):
+                # SSE: zajímají nás jen datové řádky, komentáře (keep-alive) přeskakujeme
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    yield f"CHYBA: Neplatná odpověď API: {data[:200]}"
+                    return
+                # OpenRouter hlásí chyby uprostřed streamu jako data s klíčem "error"
+                if "error" in chunk:
+                    yield f"CHYBA: API vrátilo chybu: {stream_error_message(chunk['error'])}"
+                    return
+                choices = chunk.get("choices")
+                if choices and choices[0].get("delta", {}).get("content"):
+                    received = True
+                    yield choices[0]["delta"]["content"]
+    except requests.exceptions.RequestException as e:
+        yield f"CHYBA: Nelze se připojit k API: {e}"
+        return
+    if not received:
+        yield "CHYBA: Model nevrátil žádný text."
+
 def call_ollama(prompt, cfg):
     try:
-        payload = {"model": cfg["model"], "prompt": prompt, "stream": False}
-        r = requests.post(cfg["endpoint"], json=payload, timeout=300)
+        payload = ollama_payload(prompt, cfg)
+        r = get_http_session().post(cfg["endpoint"], json=payload, timeout=cfg.get("generation_timeout", GENERATION_TIMEOUT))
         r.raise_for_status()
         return r.json()["response"]
     except requests.exceptions.RequestException as e:
         return f"CHYBA: Nelze se připojit k Ollama endpointu: {e}"
 
+def stream_ollama(prompt, cfg):
+    received = False
+    try:
+        payload = ollama_payload(prompt, cfg, stream=True)
+        with get_http_session().post(cfg["endpoint"], json=payload, stream=True, timeout=cfg.get("request_timeout", REQUEST_TIMEOUT)) as r:
+            r.raise_for_status()
+            # Ollama posílá jeden JSON objekt na řádek
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line)
+                except ValueError:
+                    yield f"CHYBA: Neplatná odpověď Ollama endpointu: {line[:200].decode('utf-8', 'replace')}"
+                    return
+                if "error" in chunk:
+                    yield f"CHYBA: Ollama vrátila chybu: {stream_error_message(chunk['error'])}"
+                    return
+                if chunk.get("response"):
+                    received = True
+                    yield chunk["response"]
+                if chunk.get("done"):
+                    break
+    except requests.exceptions.RequestException as e:
+        yield f"CHYBA: Nelze se připojit k Ollama endpointu: {e}"
+        return
+    if not received:
+        yield "CHYBA: Model nevrátil žádný text."
+
 # =========================
 # REGENERACE KAPITOLY
 # =========================
 
+def pack_version(text):
+    # starší verze se čtou zřídka, ukládají se proto komprimované
+    return {"zlib": base64.b64encode(zlib.compress(text.encode("utf-8"), 9)).decode("ascii")}
+
+def unpack_version(version):
+    # projekty z dřívějška mají verze uložené jako prostý text
+    if isinstance(version, str):
+        return version
+    return zlib.decompress(base64.b64decode(version["zlib"])).decode("utf-8")
+
+def add_version(chapter, new_text):
+    if "versions" not in chapter:
+        chapter["versions"] = [pack_version(chapter["text"])]
+    chapter["versions"].append(pack_version(new_text))
+    chapter["text"] = new_text
+
 def regenerate_chapter(project, chapter_index, model_cfg):
     chapter = project["chapters"][chapter_index]
     prompt = build_prompt(project, chapter["instruction"])
-    new_text = generate_chapter(prompt, model_cfg)
-    if "versions" not in chapter:
-        chapter["versions"] = [chapter["text"]]
-    chapter["versions"].append(new_text)
-    chapter["text"] = new_text
+    add_version(chapter, generate_chapter(prompt, model_cfg))
+
+def regenerate_chapters(project, chapter_indices, model_cfg):
+    # prompty se skládají ze stejného stavu projektu, volání modelů běží souběžně
+    prompts = [build_prompt(project, project["chapters"][i]["instruction"]) for i in chapter_indices]
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+        texts = list(executor.map(lambda prompt: generate_chapter(prompt, model_cfg), prompts))
+    for i, new_text in zip(chapter_indices, texts):
+        add_version(project["chapters"][i], new_text)
+
+# =========================
+# SHRNUTÍ DĚJE
+# =========================
+
+def update_summary(project, model_cfg):
+    # při každém uložení nejvýš jeden krok o SUMMARY_EVERY kapitol mimo posledních RECENT_CHAPTERS;
+    # po zneplatnění se shrnutí dožene postupně a jedno uložení nikdy nečeká na víc než jedno volání
+    if len(project["chapters"]) - RECENT_CHAPTERS - project.get("summary_upto", 0) < SUMMARY_EVERY:
+        return False
+    upto = project.get("summary_upto", 0) + SUMMARY_EVERY
+    summary_cfg = {**model_cfg, "temperature": SUMMARY_TEMPERATURE, "max_tokens": SUMMARY_MAX_TOKENS}
+    summary = generate_chapter(build_summary_prompt(project, upto), summary_cfg)
+    if not summary or "CHYBA:" in summary:
+        return False
+    project["summary"] = summary
+    project["summary_upto"] = upto
+    return True
+
+def reset_summary_from(project, chapter_index):
+    # změna už shrnuté kapitoly shrnutí zneplatní, kapitoly se pak posílají celé
+    if chapter_index >= project.get("summary_upto", 0):
+        return False
+    project.pop("summary", None)
+    project["summary_upto"] = 0
+    return True
+
+# =========================
+# MAZÁNÍ KAPITOLY
+# =========================
+
+def delete_open_chapter(project_name, project, chapter_index):
+    # callback běží před vykreslením, editor se tak zavře dřív, než by ukázal sousední kapitolu
+    delete_chapter(project_name, project, chapter_index)
+    st.session_state["open_chapter"] = None
 
 # =========================
 # FUNKCE PRO BEZPEČNÝ REFRESH
@@ -158,6 +513,9 @@ if selected_project == "— nový —":
             safe_refresh()
 else:
     project = load_project(selected_project)
+    if project is None:
+        st.error(f"Projekt „{selected_project}“ se nepodařilo načíst.")
+        st.stop()
 
     # -------------------------
     # EXPORT PROJEKTU
@@ -165,17 +523,9 @@ else:
 
     st.sidebar.header("📄 Export")
     if st.sidebar.button("Exportovat projekt jako .txt", key="export_txt"):
-        output = io.StringIO()
-        output.write(f"Kniha: {selected_project}\n\n")
-        output.write("=== Postavy ===\n")
-        for c in project["characters"]:
-            output.write(f"- {c['name']}: {c['description']}\n")
-        output.write("\n=== Děj ===\n")
-        for i, ch in enumerate(project["chapters"]):
-            output.write(f"Kapitola {i+1}: {ch['text']}\n\n")
         st.download_button(
             "Stáhnout .txt",
-            data=output.getvalue(),
+            data="".join(iter_export(selected_project, project)).encode("utf-8"),
             file_name=f"{selected_project}.txt",
             mime="text/plain"
         )
@@ -184,29 +534,33 @@ else:
     # MODEL + NASTAVENÍ
     # -------------------------
 
-    st.sidebar.header("🤖 AI Model")
-    selected_label = st.sidebar.selectbox("Vyber model", [m["label"] for m in MODELS], key="model_select")
-    selected_model = next(m for m in MODELS if m["label"] == selected_label)
+    with st.sidebar.form("model_settings_form", clear_on_submit=False):
+        st.header("🤖 AI Model")
+        selected_label = st.selectbox("Vyber model", MODEL_LABELS, key="model_select")
 
-    st.sidebar.header("⚙️ Nastavení generování")
-    temperature = st.sidebar.slider("Kreativita (teplota)", 0.1, 1.5, 0.9, 0.1, key="temp_slider")
-    max_tokens = st.sidebar.slider("Délka kapitoly (tokeny)", 500, 4000, 1500, 100, key="tokens_slider")
-    selected_model["temperature"] = temperature
-    selected_model["max_tokens"] = max_tokens
+        st.header("⚙️ Nastavení generování")
+        temperature = st.slider("Kreativita (teplota)", 0.1, 1.5, 0.9, 0.1, key="temp_slider")
+        max_tokens = st.slider("Délka kapitoly (tokeny)", 500, 4000, 1500, 100, key="tokens_slider")
+        st.form_submit_button("Použít nastavení")
+    selected_model = MODEL_BY_LABEL[selected_label]
+    # nastavení platí jen pro toto spuštění, sdílený seznam MODELS se nemění
+    model_cfg = {**selected_model, "temperature": temperature, "max_tokens": max_tokens}
 
     # -------------------------
     # PLOT KNIHY
     # -------------------------
 
     st.subheader("📝 Plot knihy")
-    plot_text = st.text_area(
-        "Zadej základní děj / plot knihy (kde se odehrává, struktura, klíčové momenty)",
-        value=project.get("plot", ""),
-        key="book_plot"
-    )
-    if st.button("Uložit plot", key="save_plot"):
+    with st.form("save_plot_form", clear_on_submit=False):
+        plot_text = st.text_area(
+            "Zadej základní děj / plot knihy (kde se odehrává, struktura, klíčové momenty)",
+            value=project.get("plot", ""),
+            key="book_plot"
+        )
+        plot_submitted = st.form_submit_button("Uložit plot")
+    if plot_submitted:
         project["plot"] = plot_text
-        save_project(selected_project, project)
+        save_manifest(selected_project, project)
         st.success("Plot uložen!")
         safe_refresh()
 
@@ -223,13 +577,15 @@ else:
             with col2:
                 if st.button("❌ Smazat", key=f"del_char_{i}"):
                     project["characters"].pop(i)
-                    save_project(selected_project, project)
+                    save_manifest(selected_project, project)
                     safe_refresh()
-        name = st.text_input("Jméno postavy", key="new_char_name")
-        desc = st.text_area("Popis (vzhled, povaha, vztahy)", key="new_char_desc")
-        if st.button("Přidat postavu", key="add_char"):
+        with st.form("new_char_form", clear_on_submit=False):
+            name = st.text_input("Jméno postavy", key="new_char_name")
+            desc = st.text_area("Popis (vzhled, povaha, vztahy)", key="new_char_desc")
+            char_submitted = st.form_submit_button("Přidat postavu")
+        if char_submitted:
             project["characters"].append({"name": name, "description": desc})
-            save_project(selected_project, project)
+            save_manifest(selected_project, project)
             safe_refresh()
 
     # -------------------------
@@ -237,42 +593,69 @@ else:
     # -------------------------
 
     st.subheader("📑 Kapitoly")
-    for i, chapter in enumerate(project["chapters"]):
-        with st.expander(f"Kapitola {i+1}"):
-            versions = chapter.get("versions", [chapter["text"]])
-            selected_version = st.selectbox(
-                "Verze kapitoly",
-                range(len(versions)),
-                format_func=lambda x: f"Verze {x+1}",
-                key=f"chapter_{i}_version"
-            )
-            st.text_area(
-                "Text kapitoly",
-                versions[selected_version],
-                height=300,
-                key=f"chapter_{i}_text"
-            )
+    # kapitoly se vybírají jedním selectboxem, plný editor se vykresluje jen pro vybranou
+    i = st.selectbox(
+        "Otevřít kapitolu",
+        range(len(project["chapters"])),
+        index=None,
+        format_func=lambda x: f"Kapitola {x+1}",
+        placeholder="Vyber kapitolu",
+        key="open_chapter"
+    )
+    if i is not None and i < len(project["chapters"]):
+        chapter = project["chapters"][i]
+        versions = chapter.get("versions", [chapter["text"]])
+        selected_version = st.selectbox(
+            "Verze kapitoly",
+            range(len(versions)),
+            format_func=lambda x: f"Verze {x+1}",
+            key=f"chapter_{i}_version"
+        )
+        st.text_area(
+            "Text kapitoly",
+            unpack_version(versions[selected_version]),
+            height=300,
+            key=f"chapter_{i}_text"
+        )
 
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                if st.button(f"Smazat kapitolu {i+1}", key=f"del_{i}"):
-                    project["chapters"].pop(i)
-                    save_project(selected_project, project)
-                    safe_refresh()
-            with col2:
-                if st.button(f"Regenerovat kapitolu {i+1}", key=f"regen_{i}"):
-                    regenerate_chapter(project, i, selected_model)
-                    save_project(selected_project, project)
-                    safe_refresh()
-            with col3:
-                if st.button(f"Přidat verzi jako samostatnou {i+1}", key=f"copy_{i}"):
-                    project["chapters"].append({
-                        "instruction": chapter["instruction"],
-                        "text": chapter["text"],
-                        "versions": chapter.get("versions", [chapter["text"]])
-                    })
-                    save_project(selected_project, project)
-                    safe_refresh()
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.button(
+                f"Smazat kapitolu {i+1}",
+                key=f"del_{i}",
+                on_click=delete_open_chapter,
+                args=(selected_project, project, i)
+            )
+        with col2:
+            if st.button(f"Regenerovat kapitolu {i+1}", key=f"regen_{i}"):
+                regenerate_chapter(project, i, model_cfg)
+                save_chapter(selected_project, chapter)
+                if reset_summary_from(project, i):
+                    save_manifest(selected_project, project)
+                safe_refresh()
+        with col3:
+            if st.button(f"Přidat verzi jako samostatnou {i+1}", key=f"copy_{i}"):
+                append_chapter(selected_project, project, {
+                    "instruction": chapter["instruction"],
+                    "text": chapter["text"],
+                    "versions": chapter.get("versions", [chapter["text"]])
+                })
+                safe_refresh()
+
+    if project["chapters"]:
+        regen_indices = st.multiselect(
+            "Kapitoly k regeneraci",
+            range(len(project["chapters"])),
+            format_func=lambda x: f"Kapitola {x+1}",
+            key="regen_indices"
+        )
+        if st.button("Regenerovat vybrané", key="regen_selected") and regen_indices:
+            regenerate_chapters(project, regen_indices, model_cfg)
+            for i in regen_indices:
+                save_chapter(selected_project, project["chapters"][i])
+            if reset_summary_from(project, min(regen_indices)):
+                save_manifest(selected_project, project)
+            safe_refresh()
 
 # =========================
 # NOVÁ KAPITOLA – okamžité zobrazení
@@ -282,21 +665,32 @@ if "new_chapter" not in st.session_state:
     st.session_state["new_chapter"] = None
 
 st.subheader("✍️ Nová kapitola")
-chapter_instruction = st.text_area(
-    "Popis děje kapitoly (co se má stát)",
-    height=150,
-    key="new_chapter_instr"
-)
+with st.form("new_chapter_form", clear_on_submit=False):
+    chapter_instruction = st.text_area(
+        "Popis děje kapitoly (co se má stát)",
+        height=150,
+        key="new_chapter_instr"
+    )
+    chapter_submitted = st.form_submit_button("Vygenerovat kapitolu")
+    fresh_submitted = st.form_submit_button("Vygenerovat jinou verzi")
 
 # Generování kapitoly
-if st.button("Vygenerovat kapitolu", key="gen_chapter"):
+if chapter_submitted or fresh_submitted:
     prompt = build_prompt(project, chapter_instruction)
-    chapter_text = generate_chapter(prompt, selected_model)
+    cache_key = completion_key(prompt, model_cfg)
+    # stejný prompt se stejným nastavením vrátí uloženou odpověď, jinou verzi si lze vyžádat
+    chapter_text = None if fresh_submitted else get_cached_completion(cache_key)
+    if chapter_text is None:
+        # text se vypisuje průběžně, po dokončení ho nahradí textové pole níže
+        stream_placeholder = st.empty()
+        chapter_text = stream_placeholder.write_stream(stream_chapter(prompt, model_cfg))
+        stream_placeholder.empty()
+        store_completion(cache_key, chapter_text)
     # uložíme do session_state pro okamžité zobrazení
     st.session_state["new_chapter"] = {
         "instruction": chapter_instruction,
         "text": chapter_text,
-        "versions": [chapter_text]
+        "versions": [pack_version(chapter_text)]
     }
 
 # Zobrazení nově vygenerované kapitoly
@@ -304,8 +698,11 @@ if st.session_state["new_chapter"]:
     new_ch = st.session_state["new_chapter"]
     st.text_area("✅ Vygenerovaná kapitola", new_ch["text"], height=300)
     if st.button("Uložit kapitolu do projektu"):
-        project["chapters"].append(new_ch)
-        save_project(selected_project, project)
+        append_chapter(selected_project, project, new_ch)
+        with st.spinner("Aktualizuji shrnutí děje…"):
+            summary_updated = update_summary(project, model_cfg)
+        if summary_updated:
+            save_manifest(selected_project, project)
         st.session_state["new_chapter"] = None
         st.success("Kapitola uložena do projektu!")
         safe_refresh()